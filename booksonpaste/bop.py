@@ -3,17 +3,39 @@ import sys
 import random
 import subprocess
 import argparse
-import re
-import tiktoken
 from pathlib import Path
-import requests
-from typing import Union, Optional
+from typing import Union, Optional, List, Tuple, Dict, Iterable
 import tempfile
 import os
+import json
+import hashlib
+import threading
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Cache directory for downloaded texts
 CACHE_DIR = Path.home() / '.booksonpaste' / 'cache'
 
+# Number of characters written to pbcopy per chunk
+CLIPBOARD_CHUNK_SIZE = 65536
+
+# Rough characters per token for cl100k_base on English prose
+CHARS_PER_TOKEN = 4
+
+# Number of paragraphs tokenized at a time while generating
+TOKEN_BATCH_SIZE = 256
+
+# Number of books to download concurrently
+PREFETCH_WORKERS = 8
+
+# Guards sizes.json against concurrent downloads
+_SIZES_LOCK = threading.Lock()
+
+# Shared HTTP session so downloads reuse pooled keep-alive connections,
+# created on the first download
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
 # Project Gutenberg texts to use (public domain classics)
 GUTENBERG_TEXTS = [
     # British Literature
@@ -59,6 +81,10 @@ GUTENBERG_TEXTS = [
     ('https://www.gutenberg.org/cache/epub/730/pg730.txt', 'oliver_twist'),         # Oliver Twist
 ]
 
+# Markers around the body of a Project Gutenberg text
+GUTENBERG_START_MARKER = b'*** START OF'
+GUTENBERG_END_MARKER = b'*** END OF'
+
 def parse_size(size_str: str) -> int:
     """Parse size strings like '100', '100k', '1m', '1mm' into raw numbers."""
     size_str = size_str.lower()
@@ -82,9 +108,14 @@ def ensure_cache_dir():
 
 def clear_cache():
     """Remove all cached text files."""
+    _load_paragraphs.cache_clear()
+    _load_token_lens.cache_clear()
     if CACHE_DIR.exists():
-        for file in CACHE_DIR.glob("*.txt"):
-            file.unlink()
+        with os.scandir(CACHE_DIR) as entries:
+            for entry in entries:
+                name = entry.name
+                if name.endswith(('.txt', '.tmp', '.toklen.json')) or name == 'sizes.json':
+                    os.unlink(entry.path)
 
 def ensure_clean_cache(print_message: bool = True):
     """Ensure cache directory exists and is clean. Optionally print a message."""
@@ -93,51 +124,227 @@ def ensure_clean_cache(print_message: bool = True):
     if print_message:
         print("Cache cleared.", file=sys.stderr)
 
-def download_text(url: str, filename: str) -> str:
-    """Download and cache a text file."""
+def _get_session():
+    """Create the shared HTTP session on first use."""
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            # Imported here so commands that never download skip loading requests
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            session.mount('https://', HTTPAdapter(pool_connections=PREFETCH_WORKERS, pool_maxsize=PREFETCH_WORKERS))
+            _SESSION = session
+        return _SESSION
+
+def read_cached_text(filename: str) -> str:
+    """Read a cached text, replacing any bytes that aren't valid UTF-8."""
+    return (CACHE_DIR / f"{filename}.txt").read_text(encoding='utf-8', errors='replace')
+
+def ensure_downloaded(url: str, filename: str):
+    """Download and cache a text file unless it is already cached."""
+    if not (CACHE_DIR / f"{filename}.txt").exists():
+        _fetch_text(url, filename)
+
+def _fetch_text(url: str, filename: str):
+    """Download a text, strip its boilerplate, and cache it."""
     cache_path = CACHE_DIR / f"{filename}.txt"
-    
-    if cache_path.exists():
-        return cache_path.read_text(encoding='utf-8')
-    
-    response = requests.get(url)
+    response = _get_session().get(url, stream=False, timeout=30)
     response.raise_for_status()
-    text = response.text
+    # Work on the raw bytes so the text is only decoded once
+    data = response.content.replace(b'\r\n', b'\n')
     
     # Clean up Project Gutenberg headers and footers
-    text = re.sub(r'\*\*\* START OF .+ PROJECT GUTENBERG .+ \*\*\*.*?\n', '', text, flags=re.DOTALL)
-    text = re.sub(r'\*\*\* END OF .+ PROJECT GUTENBERG .+ \*\*\*.*', '', text, flags=re.DOTALL)
+    start = data.find(GUTENBERG_START_MARKER)
+    if start >= 0:
+        line_end = data.find(b'\n', start)
+        data = data[line_end + 1:] if line_end >= 0 else b''
+    end = data.find(GUTENBERG_END_MARKER)
+    if end >= 0:
+        data = data[:end]
     
-    # Cache the cleaned text
+    # Cache the cleaned text, writing to a temporary file first so concurrent
+    # readers never see a partial file
     ensure_cache_dir()
-    cache_path.write_text(text, encoding='utf-8')
-    return text
+    fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, prefix=f"{filename}.", suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    record_book_size(filename, len(data.decode('utf-8', errors='replace')))
+
+def load_book_sizes() -> Dict[str, int]:
+    """Load the character lengths of previously downloaded texts."""
+    sizes_path = CACHE_DIR / 'sizes.json'
+    if not sizes_path.exists():
+        return {}
+    try:
+        return json.loads(sizes_path.read_text(encoding='utf-8'))
+    except ValueError:
+        return {}
+
+def record_book_size(filename: str, size: int):
+    """Record the character length of a downloaded text."""
+    with _SIZES_LOCK:
+        sizes = load_book_sizes()
+        sizes[filename] = size
+        ensure_cache_dir()
+        (CACHE_DIR / 'sizes.json').write_text(json.dumps(sizes), encoding='utf-8')
 
 def is_cache_empty() -> bool:
     """Check if the cache directory is empty or doesn't exist."""
-    return not CACHE_DIR.exists() or not any(CACHE_DIR.glob("*.txt"))
+    if not CACHE_DIR.exists():
+        return True
+    with os.scandir(CACHE_DIR) as entries:
+        return not any(entry.name.endswith('.txt') for entry in entries)
 
-def get_random_text() -> str:
-    """Get a random cached text, downloading if necessary."""
+def _pick_texts(n: int, target_chars: Optional[int] = None, exclude: Iterable[str] = ()) -> List[Tuple[str, str]]:
+    """
+    Pick up to n distinct (url, filename) sources, skipping filenames in exclude.
+    If target_chars is given, texts known to be shorter than that are less likely
+    to be picked; every other text keeps an equal chance.
+    """
+    excluded = set(exclude)
+    candidates = [source for source in GUTENBERG_TEXTS if source[1] not in excluded]
+    sizes = load_book_sizes() if target_chars else {}
+    if not sizes:
+        return random.sample(candidates, min(n, len(candidates)))
+    
+    # Texts that reach the target, or whose size is unknown, share the full
+    # weight; shorter texts are weighted by how much of the target they cover
+    weights = [max(min(sizes.get(filename, target_chars), target_chars), 1)
+               for _, filename in candidates]
+    picks = []
+    while candidates and len(picks) < n:
+        i = random.choices(range(len(candidates)), weights=weights, k=1)[0]
+        picks.append(candidates.pop(i))
+        weights.pop(i)
+    return picks
+
+def get_random_text(target_chars: Optional[int] = None) -> str:
+    """
+    Pick a random text and make sure it is cached. Returns its filename.
+    """
     if is_cache_empty():
         ensure_clean_cache(print_message=False)
-    url, filename = random.choice(GUTENBERG_TEXTS)
-    return download_text(url, filename)
+    url, filename = _pick_texts(1, target_chars)[0]
+    ensure_downloaded(url, filename)
+    return filename
+
+def prefetch_texts(n: int, target_chars: Optional[int] = None, exclude: Iterable[str] = ()) -> List[str]:
+    """
+    Fetch up to n distinct random texts concurrently, skipping filenames in exclude.
+    Returns their filenames.
+    """
+    sources = _pick_texts(n, target_chars, exclude)
+    if not sources:
+        return []
+    ensure_cache_dir()
+    with ThreadPoolExecutor(max_workers=PREFETCH_WORKERS) as executor:
+        list(executor.map(lambda source: ensure_downloaded(*source), sources))
+    return [filename for _, filename in sources]
+
+def prefetch_all(workers: int = PREFETCH_WORKERS) -> int:
+    """
+    Download every text that isn't cached yet. Returns the number downloaded.
+    A text that fails to download is reported and skipped.
+    """
+    missing = [(url, filename) for url, filename in GUTENBERG_TEXTS
+               if not (CACHE_DIR / f"{filename}.txt").exists()]
+    if not missing:
+        return 0
+    ensure_cache_dir()
+    downloaded = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(ensure_downloaded, url, filename): filename
+                   for url, filename in missing}
+        for future in as_completed(futures):
+            try:
+                future.result()
+                downloaded += 1
+            except Exception as e:
+                print(f"Warning: could not download {futures[future]}: {e}", file=sys.stderr)
+    return downloaded
 
 def copy_to_clipboard(text: str) -> bool:
     """Copy text to macOS clipboard using pbcopy."""
     try:
         process = subprocess.Popen(['pbcopy'], stdin=subprocess.PIPE)
-        process.communicate(text.encode('utf-8'))
-        return True
+        try:
+            # Encode and write in chunks so only one chunk of bytes is live at a time
+            for i in range(0, len(text), CLIPBOARD_CHUNK_SIZE):
+                process.stdin.write(text[i:i + CLIPBOARD_CHUNK_SIZE].encode('utf-8'))
+            process.stdin.close()
+        except BrokenPipeError:
+            process.wait()
+            print("Error copying to clipboard: pbcopy exited early", file=sys.stderr)
+            return False
+        return process.wait() == 0
     except Exception as e:
         print(f"Error copying to clipboard: {e}", file=sys.stderr)
         return False
 
+def write_stdout(text: Union[str, bytes]):
+    """Write text to stdout as UTF-8 in a single call, followed by a newline."""
+    data = text if isinstance(text, bytes) else text.encode('utf-8')
+    sys.stdout.buffer.write(data)
+    sys.stdout.buffer.write(b'\n')
+    sys.stdout.buffer.flush()
+
+@lru_cache(maxsize=1)
+def _get_encoder():
+    """Load the cl100k_base encoder once and reuse it."""
+    # Imported here so commands that never count tokens skip loading tiktoken
+    import tiktoken
+    return tiktoken.get_encoding("cl100k_base")
+
 def count_tokens(text: str) -> int:
     """Count tokens in text using tiktoken."""
-    enc = tiktoken.get_encoding("cl100k_base")
-    return len(enc.encode(text))
+    return len(_get_encoder().encode(text))
+
+def load_cached_token_lens(filename: str, paragraphs: List[str]) -> List[int]:
+    """
+    Get per-paragraph token counts for a cached text.
+    Counts are stored in a sidecar file next to the cached text, keyed by a
+    hash of the paragraphs so a stale sidecar is recomputed.
+    """
+    sidecar_path = CACHE_DIR / f"{filename}.toklen.json"
+    digest = hashlib.sha1('\n\n'.join(paragraphs).encode('utf-8')).hexdigest()[:16]
+    
+    if sidecar_path.exists():
+        try:
+            cached = json.loads(sidecar_path.read_text(encoding='utf-8'))
+            if cached.get('hash') == digest:
+                return cached['lens']
+        except (ValueError, KeyError):
+            pass
+    
+    token_lens = list(map(len, _get_encoder().encode_ordinary_batch(paragraphs)))
+    ensure_cache_dir()
+    sidecar_path.write_text(json.dumps({'hash': digest, 'lens': token_lens}), encoding='utf-8')
+    return token_lens
+
+@lru_cache(maxsize=len(GUTENBERG_TEXTS))
+def _load_paragraphs(filename: str) -> Tuple[Tuple[str, ...], Tuple[int, ...]]:
+    """
+    Split a cached text into stripped paragraphs.
+    Returns (paragraphs, char_lens); each length includes the paragraph separator.
+    """
+    text = read_cached_text(filename)
+    if filename not in load_book_sizes():
+        # Texts cached before sizes were recorded
+        record_book_size(filename, len(text))
+    paragraphs = tuple(filter(None, map(str.strip, text.split('\n\n'))))
+    return paragraphs, tuple(len(p) + 2 for p in paragraphs)
+
+@lru_cache(maxsize=len(GUTENBERG_TEXTS))
+def _load_token_lens(filename: str) -> Tuple[int, ...]:
+    """Get per-paragraph token counts for a cached text."""
+    paragraphs, _ = _load_paragraphs(filename)
+    return tuple(load_cached_token_lens(filename, list(paragraphs)))
 
 def format_number(n: int) -> str:
     """Format a number with commas."""
@@ -152,27 +359,68 @@ def format_output(chars: int, tokens: int, output_type: str = 'clipboard') -> st
     }
     return f"{icons[output_type]} {format_number(chars)} characters ({format_number(tokens)} tokens)"
 
-def generate_text(target_size: int, mode: str = 'chars', debug: bool = False) -> str:
+def generate_text(target_size: int, mode: str = 'chars', debug: bool = False) -> Tuple[str, Optional[int]]:
     """
     Generate text of approximately target_size.
     mode can be 'chars' or 'tokens'
     debug enables verbose output
+    Returns (text, token_count); token_count is None in 'chars' mode
     """
     print("Fetching text...", file=sys.stderr, end='', flush=True)
-    source_text = get_random_text()
+    target_chars = target_size * CHARS_PER_TOKEN if mode == 'tokens' else target_size
+    filename = get_random_text(target_chars)
+    book_paragraphs, book_char_lens = _load_paragraphs(filename)
     if debug:
-        print(f"\nSource text length: {len(source_text)}", file=sys.stderr)
-    paragraphs = [p.strip() for p in source_text.split('\n\n') if p.strip()]
+        print(f"\nSource text length: {sum(map(len, book_paragraphs))}", file=sys.stderr)
+    filenames = [filename]
+    paragraphs = list(book_paragraphs)
+    char_lens = list(book_char_lens)
+    total_chars = sum(char_lens)
+    # Token counts are only computed when the size estimate is borderline,
+    # otherwise lazily for the paragraphs actually used
+    token_lens = None
     if debug:
         print(f"Number of paragraphs: {len(paragraphs)}", file=sys.stderr)
     
-    # If we don't have enough text from one source, get more
-    while mode == 'chars' and sum(len(p) for p in paragraphs) < target_size * 1.2 or \
-          mode == 'tokens' and sum(count_tokens(p) for p in paragraphs) < target_size * 1.2:
-        print(".", file=sys.stderr, end='', flush=True)
-        additional_text = get_random_text()
-        additional_paragraphs = [p.strip() for p in additional_text.split('\n\n') if p.strip()]
-        paragraphs.extend(additional_paragraphs)
+    # If we don't have enough text from one source, fetch the estimated
+    # number of additional books in parallel
+    while True:
+        if mode == 'tokens':
+            goal = target_size * 1.5
+            current_size = total_chars // CHARS_PER_TOKEN
+            if current_size >= goal:
+                break
+            if current_size >= target_size * 1.2:
+                # Estimate is borderline, confirm with real token counts
+                token_lens = [n for f in filenames for n in _load_token_lens(f)]
+                current_size = sum(token_lens)
+                if current_size >= target_size * 1.2:
+                    break
+                token_lens = None
+        else:
+            goal = target_size * 1.2
+            current_size = total_chars
+            if current_size >= goal:
+                break
+        per_book = max(current_size // len(filenames), 1)
+        needed = -(-(int(goal) - current_size) // per_book)
+        needed = min(max(needed, 1), len(GUTENBERG_TEXTS))
+        print("." * needed, file=sys.stderr, end='', flush=True)
+        # Favor books that cover an even share of what's still missing
+        remaining_chars = (int(goal) - current_size) * (CHARS_PER_TOKEN if mode == 'tokens' else 1)
+        additional_filenames = prefetch_texts(needed, target_chars=-(-remaining_chars // needed),
+                                              exclude=filenames)
+        if not additional_filenames:
+            # Every text is already in use, so repeat some of them
+            additional_filenames = random.choices(list(dict.fromkeys(filenames)), k=needed)
+            if debug:
+                print(f"\nAll texts in use, repeating {needed}", file=sys.stderr)
+        for additional_filename in additional_filenames:
+            additional_paragraphs, additional_char_lens = _load_paragraphs(additional_filename)
+            filenames.append(additional_filename)
+            paragraphs.extend(additional_paragraphs)
+            char_lens.extend(additional_char_lens)
+            total_chars += sum(additional_char_lens)
     
     print("\nGenerating...", file=sys.stderr)
     if debug:
@@ -183,6 +431,11 @@ def generate_text(target_size: int, mode: str = 'chars', debug: bool = False) ->
     if debug:
         print(f"Starting at paragraph {start_idx}", file=sys.stderr)
     
+    if mode == 'tokens':
+        enc = _get_encoder()
+        if token_lens is None:
+            token_lens = [None] * len(paragraphs)
+    
     result = []
     current_size = 0
     current_idx = start_idx
@@ -192,31 +445,33 @@ def generate_text(target_size: int, mode: str = 'chars', debug: bool = False) ->
         paragraph = paragraphs[current_idx]
         
         if mode == 'tokens':
-            next_size = count_tokens(paragraph)
+            if token_lens[current_idx] is None:
+                # Tokenize a batch of upcoming paragraphs, stopping short of
+                # the already-counted ones at the starting point
+                limit = start_idx if current_idx < start_idx else len(paragraphs)
+                batch_end = min(current_idx + TOKEN_BATCH_SIZE, limit)
+                batch = enc.encode_ordinary_batch(paragraphs[current_idx:batch_end])
+                token_lens[current_idx:batch_end] = map(len, batch)
+            next_size = token_lens[current_idx]
         else:
-            next_size = len(paragraph + '\n\n')  # Include newlines in size calculation
+            next_size = char_lens[current_idx]
             
         # Stop if adding this paragraph would exceed target size
         if current_size + next_size > target_size:
             # If this is the first paragraph and it's too big, take a portion
             if not result:
                 if mode == 'tokens':
-                    words = paragraph.split()
-                    partial = []
-                    partial_size = 0
-                    for word in words:
-                        word_size = count_tokens(word + ' ')
-                        if partial_size + word_size > target_size:
-                            break
-                        partial.append(word)
-                        partial_size += word_size
-                    if partial:
-                        result.append(' '.join(partial) + '\n\n')
+                    ids = enc.encode_ordinary(paragraph)[:target_size]
+                    # The cut can land inside a multi-byte character, so drop
+                    # the incomplete bytes rather than emit a replacement character
+                    partial = enc.decode_bytes(ids).decode('utf-8', errors='ignore')
+                    result.append(partial)
+                    current_size = len(enc.encode_ordinary(partial))
                 else:
-                    result.append(paragraph[:target_size - 2] + '\n\n')
+                    result.append(paragraph[:target_size - 2])
             break
             
-        result.append(paragraph + '\n\n')
+        result.append(paragraph)
         current_size += next_size
         if debug:
             print(f"Added paragraph {current_idx}, current size: {current_size}", file=sys.stderr)
@@ -228,7 +483,11 @@ def generate_text(target_size: int, mode: str = 'chars', debug: bool = False) ->
         if current_idx == start_idx:
             break
     
-    return ''.join(result)
+    # Join once with a trailing separator rather than copying each paragraph
+    # to attach its newlines
+    text = '\n\n'.join(result) + '\n\n' if result else ''
+    token_count = current_size if mode == 'tokens' else None
+    return text, token_count
 
 def main():
     try:
@@ -241,43 +500,64 @@ Examples:
   bop -t 1m           # Copy 1 million tokens to clipboard
   bop 50k -s          # Output 50k characters to stdout
   bop -t 100 -f out.txt  # Write 100 tokens to file
-  bop 1m --new        # Clear cache and generate new text
+  bop 1m --new        # Clear cache, download every book, and generate text
   bop --gen 100k      # Just generate text without copying/saving
   bop --clear         # Clear the cache without generating text
+  bop --prefetch      # Download every book into the cache
+  bop --prefetch -j 16  # Download every book using 16 parallel downloads
   bop 100k --debug    # Show detailed progress information"""
         )
         parser.add_argument('size', nargs='?', help='Amount of text to generate (e.g., 100, 100k, 1m)')
         parser.add_argument('-t', '--tokens', action='store_true', help='Count in tokens instead of characters')
         parser.add_argument('-s', '--stdout', action='store_true', help='Output to stdout instead of clipboard')
         parser.add_argument('-f', '--file', nargs='?', const='bop-output.txt', help='Output to file (optional filename)')
-        parser.add_argument('-n', '--new', action='store_true', help='Clear cache and fetch new text')
+        parser.add_argument('-n', '--new', action='store_true', help='Clear cache and download every text before generating')
         parser.add_argument('-g', '--gen', action='store_true', help='Just generate and display text without copying')
         parser.add_argument('-c', '--clear', action='store_true', help='Clear the cache without generating text')
+        parser.add_argument('-p', '--prefetch', action='store_true', help='Download all texts into the cache')
+        parser.add_argument('-j', '--jobs', type=int, default=PREFETCH_WORKERS, metavar='N',
+                            help=f'Number of parallel downloads for --prefetch and --new (default: {PREFETCH_WORKERS})')
         parser.add_argument('-d', '--debug', action='store_true', help='Show detailed progress information')
         
         args = parser.parse_args()
         
         try:
+            if args.jobs < 1:
+                parser.error("--jobs must be at least 1")
+
             # Handle clear command
             if args.clear:
                 ensure_clean_cache()
                 return
 
+            # Warm the cache if requested
+            if args.prefetch:
+                if args.new:
+                    ensure_clean_cache()
+                print("Fetching texts...", file=sys.stderr)
+                count = prefetch_all(workers=args.jobs)
+                print(f"Cached {count} texts.", file=sys.stderr)
+                if not args.size:
+                    return
+
             # Ensure size is provided for text generation
             if not args.size:
-                parser.error("size argument is required unless using --clear")
+                parser.error("size argument is required unless using --clear or --prefetch")
                 
-            # Clear cache if requested
-            if args.new:
+            # Clear cache and refetch all texts if requested
+            if args.new and not args.prefetch:
                 ensure_clean_cache()
+                print("Fetching texts...", file=sys.stderr)
+                prefetch_all(workers=args.jobs)
                 
             target_size = parse_size(args.size)
             mode = 'tokens' if args.tokens else 'chars'
             
             # Generate text
-            text = generate_text(target_size, mode, debug=args.debug)
+            text, token_count = generate_text(target_size, mode, debug=args.debug)
             char_count = len(text)
-            token_count = count_tokens(text)
+            if token_count is None:
+                token_count = count_tokens(text)
             
             # Handle output based on flags
             if args.gen or args.stdout or args.file:
@@ -287,7 +567,7 @@ Examples:
                     print(format_output(char_count, token_count, 'file'), file=sys.stderr)
                 else:
                     try:
-                        print(text)
+                        write_stdout(text)
                         print(format_output(char_count, token_count, 'stdout'), file=sys.stderr)
                     except BrokenPipeError:
                         # Python flushes standard streams on exit; redirect remaining output
@@ -300,7 +580,7 @@ Examples:
                     print(format_output(char_count, token_count, 'clipboard'), file=sys.stderr)
                 else:
                     print("Failed to copy to clipboard, outputting to stdout:", file=sys.stderr)
-                    print(text)
+                    write_stdout(text)
                     print(format_output(char_count, token_count, 'stdout'), file=sys.stderr)
                     
         except ValueError as e:
@@ -2,7 +2,9 @@ import pytest
 from pathlib import Path
 import tempfile
 import shutil
+import json
 from unittest.mock import patch, Mock
+import booksonpaste.bop
 from booksonpaste.bop import (
     parse_size,
     format_number,
@@ -10,11 +12,20 @@ from booksonpaste.bop import (
     count_tokens,
     generate_text,
     CACHE_DIR,
-    download_text,
+    ensure_downloaded,
+    read_cached_text,
     clear_cache,
     ensure_cache_dir,
     is_cache_empty,
     copy_to_clipboard,
+    prefetch_texts,
+    prefetch_all,
+    write_stdout,
+    main,
+    _load_paragraphs,
+    get_random_text,
+    load_book_sizes,
+    load_cached_token_lens,
 )
 
 # Mock text for testing
@@ -92,7 +103,6 @@ def clean_temp_cache_dir():
     with tempfile.TemporaryDirectory() as tmpdir:
         temp_dir = Path(tmpdir) / '.booksonpaste' / 'cache'
         # Temporarily replace CACHE_DIR
-        import booksonpaste.bop
         booksonpaste.bop.CACHE_DIR = temp_dir
         yield temp_dir
         # Restore original CACHE_DIR
@@ -117,23 +127,74 @@ def test_cache_management(clean_temp_cache_dir):
     clear_cache()
     assert is_cache_empty()
 
+# Test token count sidecar caching
+def test_load_cached_token_lens(clean_temp_cache_dir):
+    """Test that token counts are written once and reused until the text changes."""
+    paragraphs = ["First paragraph.", "Second paragraph."]
+    with patch('booksonpaste.bop._get_encoder') as mock_get_encoder:
+        mock_get_encoder.return_value.encode_ordinary_batch.return_value = [[1, 2], [3, 4, 5]]
+        
+        assert load_cached_token_lens("test", paragraphs) == [2, 3]
+        assert (clean_temp_cache_dir / "test.toklen.json").exists()
+        
+        # Unchanged paragraphs should be served from the sidecar
+        assert load_cached_token_lens("test", paragraphs) == [2, 3]
+        mock_get_encoder.return_value.encode_ordinary_batch.assert_called_once()
+        
+        # Changed paragraphs should invalidate the sidecar
+        mock_get_encoder.return_value.encode_ordinary_batch.return_value = [[1]]
+        assert load_cached_token_lens("test", ["Changed."]) == [1]
+        assert mock_get_encoder.return_value.encode_ordinary_batch.call_count == 2
+
 # Test clipboard operations
 def test_copy_to_clipboard():
     """Test clipboard operations with mocked subprocess."""
     with patch('subprocess.Popen') as mock_popen:
         mock_process = Mock()
-        mock_process.communicate.return_value = (None, None)
+        mock_process.wait.return_value = 0
         mock_popen.return_value = mock_process
         
         assert copy_to_clipboard("test text")
         mock_popen.assert_called_once()
-        mock_process.communicate.assert_called_once()
+        mock_process.stdin.write.assert_called_once_with(b"test text")
+        mock_process.stdin.close.assert_called_once()
+
+def test_copy_to_clipboard_chunked():
+    """Test that large text is streamed to pbcopy in chunks."""
+    text = "x" * (booksonpaste.bop.CLIPBOARD_CHUNK_SIZE * 2 + 10)
+    with patch('subprocess.Popen') as mock_popen:
+        mock_process = Mock()
+        mock_process.wait.return_value = 0
+        mock_popen.return_value = mock_process
+        
+        assert copy_to_clipboard(text)
+        assert mock_process.stdin.write.call_count == 3
+        written = b"".join(call.args[0] for call in mock_process.stdin.write.call_args_list)
+        assert written == text.encode('utf-8')
+
+def test_copy_to_clipboard_broken_pipe():
+    """Test clipboard operations when pbcopy exits early."""
+    with patch('subprocess.Popen') as mock_popen:
+        mock_process = Mock()
+        mock_process.stdin.write.side_effect = BrokenPipeError
+        mock_popen.return_value = mock_process
+        
+        assert not copy_to_clipboard("test text")
 
 def test_copy_to_clipboard_failure():
     """Test clipboard operations failure."""
     with patch('subprocess.Popen', side_effect=Exception("Mock error")):
         assert not copy_to_clipboard("test text")
 
+# Test stdout output
+def test_write_stdout(capsysbinary):
+    """Test that text is written to stdout as UTF-8 bytes."""
+    write_stdout("café")
+    assert capsysbinary.readouterr().out == "café\n".encode('utf-8')
+    
+    write_stdout(b"raw")
+    assert capsysbinary.readouterr().out == b"raw\n"
+
 # Test text generation
 @pytest.fixture
 def temp_cache_dir():
@@ -146,25 +207,30 @@ def temp_cache_dir():
         cache_file = temp_dir / "mock_text.txt"
         cache_file.write_text(MOCK_TEXT)
         # Temporarily replace CACHE_DIR
-        import booksonpaste.bop
         booksonpaste.bop.CACHE_DIR = temp_dir
         yield temp_dir
-        # Restore original CACHE_DIR
+        # Restore original CACHE_DIR and drop paragraphs cached from it
         booksonpaste.bop.CACHE_DIR = original_cache_dir
+        booksonpaste.bop._load_paragraphs.cache_clear()
+        booksonpaste.bop._load_token_lens.cache_clear()
 
 @pytest.fixture
 def mock_text_sources(monkeypatch):
     """Mock text sources to return our test text."""
-    def mock_get_random_text():
-        return MOCK_TEXT
+    def mock_get_random_text(target_chars=None):
+        return 'mock_text'
+    
+    def mock_prefetch_texts(n, target_chars=None, exclude=()):
+        return ['mock_text'] * n
     
     monkeypatch.setattr('booksonpaste.bop.get_random_text', mock_get_random_text)
+    monkeypatch.setattr('booksonpaste.bop.prefetch_texts', mock_prefetch_texts)
     yield
 
 def test_generate_text_chars(temp_cache_dir, mock_text_sources):
     """Test character-based text generation."""
     target_size = 100
-    text = generate_text(target_size, mode='chars', debug=False)
+    text, _ = generate_text(target_size, mode='chars', debug=False)
     # Should not exceed target size
     assert len(text) <= target_size
     # Should be reasonably close to target (within 20%)
@@ -173,16 +239,60 @@ def test_generate_text_chars(temp_cache_dir, mock_text_sources):
 def test_generate_text_tokens(temp_cache_dir, mock_text_sources):
     """Test token-based text generation."""
     target_size = 100
-    text = generate_text(target_size, mode='tokens', debug=False)
+    text, reported_count = generate_text(target_size, mode='tokens', debug=False)
     token_count = count_tokens(text)
+    assert reported_count <= target_size
     # Should not exceed target size
     assert token_count <= target_size
     # Should be reasonably close to target (within 20%)
     assert token_count >= target_size * 0.8
 
+class WordEncoder:
+    """Stand-in for the tiktoken encoder that treats each word as a token."""
+    def encode_ordinary(self, text):
+        return text.split()
+
+    def encode_ordinary_batch(self, texts):
+        return [self.encode_ordinary(t) for t in texts]
+
+    def decode(self, ids):
+        return ' '.join(ids)
+
+    def decode_bytes(self, ids):
+        return self.decode(ids).encode('utf-8')
+
+def test_generate_text_tokens_estimate(temp_cache_dir, mock_text_sources):
+    """Test that token mode skips full tokenization when one text is clearly enough."""
+    with patch('booksonpaste.bop._get_encoder', return_value=WordEncoder()), \
+         patch('booksonpaste.bop._load_token_lens') as mock_load_token_lens:
+        text, token_count = generate_text(20, mode='tokens', debug=False)
+        mock_load_token_lens.assert_not_called()
+    assert token_count == len(text.split())
+    assert 0 < token_count <= 20
+
+class ByteEncoder(WordEncoder):
+    """Stand-in for the tiktoken encoder that treats each UTF-8 byte as a token."""
+    def encode_ordinary(self, text):
+        return list(text.encode('utf-8'))
+
+    def decode_bytes(self, ids):
+        return bytes(ids)
+
+    def decode(self, ids):
+        return bytes(ids).decode('utf-8', errors='replace')
+
+def test_generate_text_tokens_multibyte_cut(temp_cache_dir, monkeypatch):
+    """Test that truncating inside a multi-byte character doesn't emit U+FFFD."""
+    (temp_cache_dir / "accents.txt").write_text("é" * 100, encoding='utf-8')
+    monkeypatch.setattr('booksonpaste.bop.get_random_text', lambda target_chars=None: 'accents')
+    with patch('booksonpaste.bop._get_encoder', return_value=ByteEncoder()):
+        text, token_count = generate_text(5, mode='tokens', debug=False)
+    assert text == "éé\n\n"
+    assert token_count == 4
+
 def test_generate_text_wrapping(temp_cache_dir, mock_text_sources):
     """Test that generated text maintains paragraph structure."""
-    text = generate_text(1000, mode='chars', debug=False)
+    text, _ = generate_text(1000, mode='chars', debug=False)
     paragraphs = [p for p in text.split('\n\n') if p.strip()]
     # Should have at least one paragraph
     assert len(paragraphs) > 0
@@ -192,34 +302,253 @@ def test_generate_text_wrapping(temp_cache_dir, mock_text_sources):
 def test_generate_text_debug_output(temp_cache_dir, mock_text_sources, capsys):
     """Test that debug output is only shown when debug=True."""
     # Test without debug
-    text = generate_text(100, mode='chars', debug=False)
+    text, _ = generate_text(100, mode='chars', debug=False)
     captured = capsys.readouterr()
     assert "Source text length:" not in captured.err
     assert "Number of paragraphs:" not in captured.err
     assert "Added paragraph" not in captured.err
     
     # Test with debug
-    text = generate_text(100, mode='chars', debug=True)
+    text, _ = generate_text(100, mode='chars', debug=True)
     captured = capsys.readouterr()
     assert "Source text length:" in captured.err
     assert "Number of paragraphs:" in captured.err
     assert "Total paragraphs available:" in captured.err
 
-def test_download_text(temp_cache_dir):
-    """Test text downloading and caching."""
-    with patch('requests.get') as mock_get:
-        mock_response = Mock()
-        mock_response.text = MOCK_TEXT
-        mock_response.raise_for_status.return_value = None
-        mock_get.return_value = mock_response
+def test_generate_text_fetches_more(temp_cache_dir, mock_text_sources):
+    """Test that large targets pull in additional texts."""
+    text, _ = generate_text(1000, mode='chars', debug=False)
+    assert len(text) <= 1000
+    assert len(text) >= 1000 * 0.8
+
+def test_generate_text_repeats_when_texts_run_out(temp_cache_dir, mock_text_sources, monkeypatch):
+    """Test that texts are repeated once every text is in use."""
+    monkeypatch.setattr('booksonpaste.bop.prefetch_texts', lambda n, target_chars=None, exclude=(): [])
+    text, _ = generate_text(5000, mode='chars', debug=False)
+    assert len(text) <= 5000
+    assert len(text) >= 5000 * 0.8
+
+def test_generate_text_reads_source_once(temp_cache_dir):
+    """Test that the chosen text is read from the cache only once."""
+    with patch('booksonpaste.bop._pick_texts', return_value=[('https://example.com/mock.txt', 'mock_text')]), \
+         patch('booksonpaste.bop.read_cached_text', wraps=booksonpaste.bop.read_cached_text) as mock_read:
+        text, _ = generate_text(100, mode='chars', debug=False)
+    mock_read.assert_called_once_with('mock_text')
+    assert text
+
+# Test paragraph loading
+def test_load_paragraphs_cached(temp_cache_dir):
+    """Test that cached texts are split once and reused."""
+    paragraphs, char_lens = _load_paragraphs("mock_text")
+    assert len(paragraphs) == 3
+    # Texts cached without a recorded size get one when loaded
+    assert load_book_sizes() == {"mock_text": len(MOCK_TEXT)}
+    assert char_lens == tuple(len(p) + 2 for p in paragraphs)
+    
+    # Later reads come from memory, not disk
+    (temp_cache_dir / "mock_text.txt").unlink()
+    assert _load_paragraphs("mock_text") == (paragraphs, char_lens)
+    
+    # Clearing the cache drops the in-memory split as well
+    clear_cache()
+    with pytest.raises(FileNotFoundError):
+        _load_paragraphs("mock_text")
+
+# Test text downloading
+@pytest.fixture
+def mock_download():
+    """Patch the HTTP session; call the returned function to set the response body."""
+    with patch('booksonpaste.bop._get_session') as mock_get_session:
+        mock_get = mock_get_session.return_value.get
         
-        # Test downloading new text
-        text = download_text("https://example.com/test.txt", "test")
-        assert text == MOCK_TEXT
-        mock_get.assert_called_once()
+        def set_content(content):
+            mock_response = Mock()
+            mock_response.content = content.encode('utf-8') if isinstance(content, str) else content
+            mock_response.raise_for_status.return_value = None
+            mock_get.return_value = mock_response
+            return mock_get
         
-        # Test using cached text
-        text = download_text("https://example.com/test.txt", "test")
-        assert text == MOCK_TEXT
-        # Should not call requests.get again
-        mock_get.assert_called_once() 
\ No newline at end of file
+        yield set_content
+
+def test_ensure_downloaded(temp_cache_dir, mock_download):
+    """Test text downloading and caching."""
+    mock_get = mock_download(MOCK_TEXT)
+    
+    # Test downloading new text
+    ensure_downloaded("https://example.com/test.txt", "test")
+    assert read_cached_text("test") == MOCK_TEXT
+    mock_get.assert_called_once()
+    
+    # Test using cached text
+    ensure_downloaded("https://example.com/test.txt", "test")
+    assert read_cached_text("test") == MOCK_TEXT
+    # Should not call the session again
+    mock_get.assert_called_once()
+
+def test_ensure_downloaded_strips_boilerplate(temp_cache_dir, mock_download):
+    """Test that Project Gutenberg headers and footers are removed."""
+    mock_download(
+        "Project Gutenberg header\n"
+        "*** START OF THE PROJECT GUTENBERG EBOOK TEST ***\n"
+        + MOCK_TEXT +
+        "*** END OF THE PROJECT GUTENBERG EBOOK TEST ***\n"
+        "License text\n"
+    )
+    ensure_downloaded("https://example.com/test.txt", "gutenberg")
+    assert read_cached_text("gutenberg") == MOCK_TEXT
+
+def test_ensure_downloaded_normalizes_newlines(temp_cache_dir, mock_download):
+    """Test that CRLF line endings are cached as plain newlines."""
+    mock_download(MOCK_TEXT.replace('\n', '\r\n'))
+    ensure_downloaded("https://example.com/test.txt", "crlf")
+    assert (temp_cache_dir / "crlf.txt").read_bytes() == MOCK_TEXT.encode('utf-8')
+
+def test_ensure_downloaded_atomic(temp_cache_dir, mock_download):
+    """Test that texts are only moved into the cache once fully written."""
+    real_replace = booksonpaste.bop.os.replace
+    
+    def checked_replace(src, dst):
+        assert not Path(dst).exists()
+        assert Path(src).read_bytes() == MOCK_TEXT.encode('utf-8')
+        real_replace(src, dst)
+    
+    mock_download(MOCK_TEXT)
+    with patch('booksonpaste.bop.os.replace', side_effect=checked_replace) as mock_replace:
+        ensure_downloaded("https://example.com/test.txt", "atomic")
+    mock_replace.assert_called_once()
+    assert (temp_cache_dir / "atomic.txt").read_text() == MOCK_TEXT
+    assert not list(temp_cache_dir.glob("*.tmp"))
+
+def test_ensure_downloaded_invalid_utf8(temp_cache_dir, mock_download):
+    """Test that bytes that aren't UTF-8 are replaced when the cached text is read."""
+    mock_download(b"Caf\xe9 paragraph.\n\nSecond paragraph.\n")
+    ensure_downloaded("https://example.com/test.txt", "latin1")
+    assert read_cached_text("latin1") == "Caf\ufffd paragraph.\n\nSecond paragraph.\n"
+    paragraphs, _ = _load_paragraphs("latin1")
+    assert paragraphs == ("Caf\ufffd paragraph.", "Second paragraph.")
+
+def test_ensure_downloaded_records_size(temp_cache_dir, mock_download):
+    """Test that downloaded texts have their length recorded."""
+    mock_download(MOCK_TEXT)
+    ensure_downloaded("https://example.com/test.txt", "test")
+    assert load_book_sizes() == {"test": len(MOCK_TEXT)}
+    
+    clear_cache()
+    assert load_book_sizes() == {}
+
+# Test text selection and prefetching
+@pytest.fixture
+def recorded_weights():
+    """Record the weights passed to random.choices when picking texts."""
+    real_choices = booksonpaste.bop.random.choices
+    recorded = []
+    def recording_choices(*args, **kwargs):
+        recorded.append(list(kwargs['weights']))
+        return real_choices(*args, **kwargs)
+    
+    with patch('random.choices', side_effect=recording_choices):
+        yield recorded
+
+def test_get_random_text_weighted(temp_cache_dir, recorded_weights):
+    """Test that texts shorter than the target are less likely to be picked."""
+    big_name = booksonpaste.bop.GUTENBERG_TEXTS[0][1]
+    small_name = booksonpaste.bop.GUTENBERG_TEXTS[1][1]
+    (temp_cache_dir / 'sizes.json').write_text(json.dumps({big_name: 1000000, small_name: 200}))
+    
+    with patch('booksonpaste.bop.ensure_downloaded'):
+        get_random_text(1000)
+    weights = recorded_weights[0]
+    assert weights[0] == 1000
+    assert weights[1] == 200
+    assert all(w == 1000 for w in weights[2:])
+
+def test_get_random_text_large_book_small_target(temp_cache_dir, recorded_weights):
+    """Test that a known large text doesn't crowd out texts of unknown size."""
+    big_name = booksonpaste.bop.GUTENBERG_TEXTS[0][1]
+    (temp_cache_dir / 'sizes.json').write_text(json.dumps({big_name: 700000}))
+    
+    with patch('booksonpaste.bop.ensure_downloaded'):
+        picks = [get_random_text(100) for _ in range(300)]
+    assert all(weights == [100] * len(booksonpaste.bop.GUTENBERG_TEXTS) for weights in recorded_weights)
+    # Uniform picking expects about 10 of 300; crowding out would be nearly all
+    assert picks.count(big_name) < 60
+
+def test_prefetch_texts_weighted(temp_cache_dir, recorded_weights):
+    """Test that additional picks favor texts long enough for the target."""
+    sizes = {filename: 100 for _, filename in booksonpaste.bop.GUTENBERG_TEXTS}
+    big_name = booksonpaste.bop.GUTENBERG_TEXTS[3][1]
+    sizes[big_name] = 10_000_000
+    (temp_cache_dir / 'sizes.json').write_text(json.dumps(sizes))
+    
+    with patch('booksonpaste.bop.ensure_downloaded'):
+        filenames = prefetch_texts(5, target_chars=1000)
+    first_weights = recorded_weights[0]
+    assert first_weights[3] == 1000
+    assert all(w == 100 for i, w in enumerate(first_weights) if i != 3)
+    # Picks stay distinct even when weighted
+    assert len(set(filenames)) == 5
+
+def test_get_random_text_uniform_without_sizes(temp_cache_dir):
+    """Test that selection is uniform when no sizes are known."""
+    with patch('random.choices') as mock_choices, \
+         patch('booksonpaste.bop.ensure_downloaded') as mock_ensure_downloaded:
+        filename = get_random_text(1000)
+    mock_choices.assert_not_called()
+    mock_ensure_downloaded.assert_called_once()
+    assert mock_ensure_downloaded.call_args.args[1] == filename
+
+def test_prefetch_texts(temp_cache_dir):
+    """Test that prefetching downloads distinct texts that aren't excluded."""
+    all_filenames = [filename for _, filename in booksonpaste.bop.GUTENBERG_TEXTS]
+    excluded = all_filenames[:5]
+    with patch('booksonpaste.bop.ensure_downloaded') as mock_ensure_downloaded:
+        filenames = prefetch_texts(len(all_filenames), exclude=excluded)
+    assert len(filenames) == len(set(filenames)) == len(all_filenames) - 5
+    assert not set(filenames) & set(excluded)
+    downloaded = [call.args[1] for call in mock_ensure_downloaded.call_args_list]
+    assert sorted(downloaded) == sorted(filenames)
+    
+    with patch('booksonpaste.bop.ensure_downloaded') as mock_ensure_downloaded:
+        assert prefetch_texts(3, exclude=all_filenames) == []
+    mock_ensure_downloaded.assert_not_called()
+
+def test_prefetch_all(temp_cache_dir):
+    """Test that only uncached texts are downloaded."""
+    url, filename = booksonpaste.bop.GUTENBERG_TEXTS[0]
+    (temp_cache_dir / f"{filename}.txt").write_text(MOCK_TEXT)
+    
+    with patch('booksonpaste.bop.ensure_downloaded') as mock_download:
+        assert prefetch_all(workers=2) == len(booksonpaste.bop.GUTENBERG_TEXTS) - 1
+        downloaded = {call.args[1] for call in mock_download.call_args_list}
+    assert filename not in downloaded
+    assert len(downloaded) == len(booksonpaste.bop.GUTENBERG_TEXTS) - 1
+
+def test_prefetch_all_failure(temp_cache_dir, capsys):
+    """Test that one failed download is reported without aborting the rest."""
+    def fake_download(url, filename):
+        if filename == 'moby_dick':
+            raise RuntimeError("404")
+    
+    with patch('booksonpaste.bop.ensure_downloaded', side_effect=fake_download):
+        assert prefetch_all(workers=2) == len(booksonpaste.bop.GUTENBERG_TEXTS) - 1
+    assert "could not download moby_dick: 404" in capsys.readouterr().err
+
+@pytest.mark.parametrize("argv", [
+    ['bop', '--prefetch', '-j', '3'],
+    ['bop', '--prefetch', '--jobs', '3'],
+])
+def test_main_prefetch_jobs(temp_cache_dir, monkeypatch, argv):
+    """Test that --jobs sets the number of parallel downloads."""
+    monkeypatch.setattr('sys.argv', argv)
+    with patch('booksonpaste.bop.prefetch_all', return_value=0) as mock_prefetch_all:
+        main()
+    mock_prefetch_all.assert_called_once_with(workers=3)
+
+# Test lazy imports
+def test_import_skips_heavy_dependencies():
+    """Test that importing the CLI doesn't load tiktoken or requests."""
+    import subprocess
+    import sys
+    code = "import sys, booksonpaste.bop; print('tiktoken' in sys.modules, 'requests' in sys.modules)"
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+    assert output.split() == ['False', 'False']